@@ -1,18 +1,30 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 from datetime import datetime
 from io import BytesIO
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
-from reportlab.lib.units import cm
-from reportlab.lib.utils import ImageReader
 import calendar
+import json
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 # -----------------------------
 # CONFIG
 # -----------------------------
-DATA_FILE = "finanze.json"
+DATA_FILE = "finanze.parquet"
+LEGACY_FILE = "finanze.json"
+# Le nuove operazioni vengono accodate qui e consolidate nel Parquet oltre la soglia
+JOURNAL_FILE = "finanze_journal.ndjson"
+JOURNAL_MAX_BYTES = 64 * 1024
+# Entrate e uscite per mese: bastano alla Dashboard. A ogni inserimento si aggiorna
+# solo la riga del mese interessato; il ricalcolo completo serve solo se non è allineato
+RIEPILOGO_FILE = "finanze_riepilogo.parquet"
+COLONNE = ["Data", "Portafoglio", "Tipo", "Categoria", "Descrizione", "Importo"]
+TIPI = ["Entrata", "Uscita"]
 PORTAFOGLI = ["Isybank", "Postepay", "Paypal", "Contanti"]
 CATEGORIE = [
     "Stipendio", "Bonus", "Regali o entrate occasionali",  # Entrate
@@ -23,6 +35,10 @@ CATEGORIE = [
     "Salute", "Educazione / Formazione", "Investimenti",
     "Varie ed eventuali"                                   # Altro
 ]
+# Vocabolari fissi delle colonne salvate come category
+CATEGORICHE = {"Portafoglio": PORTAFOGLI, "Tipo": TIPI, "Categoria": CATEGORIE}
+
+plt.rcParams["path.simplify"] = True
 
 st.set_page_config(page_title="💰 Gestionale Finanziario", layout="wide")
 st.title("💰 Gestionale Personale Multi-Portafoglio")
@@ -30,118 +46,288 @@ st.title("💰 Gestionale Personale Multi-Portafoglio")
 # -----------------------------
 # FUNZIONI
 # -----------------------------
-def load_data():
+def stato_file(path):
+    # mtime e dimensione: due accodamenti nello stesso istante (filesystem con
+    # risoluzione di 1 s) restano comunque distinguibili dalla dimensione
+    try:
+        stato = os.stat(path)
+        return (stato.st_mtime_ns, stato.st_size)
+    except OSError:
+        return (0, 0)
+
+def versione_dati():
+    # Chiave della cache di load_data: cambia a ogni scrittura su archivio o journal
+    return (stato_file(DATA_FILE), stato_file(JOURNAL_FILE))
+
+def applica_schema(df):
+    df = df.reindex(columns=COLONNE)
+    df["Data"] = pd.to_datetime(df["Data"], errors="coerce")
+    df["Importo"] = df["Importo"].astype(float)
+    for col, valori in CATEGORICHE.items():
+        # I valori fuori vocabolario vengono accodati, non persi
+        extra = sorted(set(df[col].dropna().unique()) - set(valori))
+        df[col] = df[col].astype(pd.CategoricalDtype(valori + extra))
+    # Mese di competenza calcolato una volta sola qui, non in ogni sezione
+    mesi = df["Data"].values.astype("datetime64[M]")
+    df["AnnoMese"] = mesi.astype("datetime64[ns]")
+    # Stesso mese come intero anno*12+mese: i filtri confrontano int32, non date
+    df["IdMese"] = np.where(np.isnat(mesi), -1, mesi.astype(np.int64) + 1970 * 12 + 1).astype(np.int32)
+    return df
+
+def id_mese(anno, mese):
+    return anno * 12 + mese
+
+def righe_del_mese(df, anno, mese):
+    # df arriva ordinato da load_data: due ricerche binarie e una slice, niente maschera
+    inizio, fine = np.searchsorted(df["IdMese"].values, [id_mese(anno, mese), id_mese(anno, mese) + 1])
+    return df.iloc[inizio:fine]
+
+@st.cache_data(show_spinner=False)
+def load_archivio(stato):
+    try:
+        return pd.read_parquet(DATA_FILE, engine="pyarrow")
+    except (FileNotFoundError, ValueError):
+        return pd.DataFrame(columns=COLONNE)
+
+def leggi_journal():
+    try:
+        with open(JOURNAL_FILE, encoding="utf-8") as f:
+            return [json.loads(riga) for riga in f if riga.strip()]
+    except FileNotFoundError:
+        return []
+
+@st.cache_data(show_spinner=False)
+def load_data(versione):
+    # Dopo un inserimento l'archivio arriva dalla cache: si rilegge solo il journal
+    df = load_archivio(versione[0])
+    righe = leggi_journal()
+    if righe:
+        nuove = pd.DataFrame(righe, columns=COLONNE)
+        df = nuove if df.empty else pd.concat([df, nuove], ignore_index=True)
+    df = applica_schema(df)
+    # Ordine cronologico, date mancanti in testa: IdMese resta monotono (vedi righe_del_mese)
+    return df.sort_values("Data", na_position="first", kind="stable", ignore_index=True)
+
+def calcola_riepilogo(df):
+    riepilogo = df.pivot_table(index="AnnoMese", columns="Tipo", values="Importo",
+                               aggfunc="sum", fill_value=0.0, observed=True)
+    riepilogo = riepilogo.reindex(columns=TIPI, fill_value=0.0)
+    # Parquet accetta solo nomi di colonna stringa, non category
+    riepilogo.columns = TIPI
+    return riepilogo
+
+@st.cache_data(show_spinner=False)
+def load_riepilogo(stato):
     try:
-        df = pd.read_json(DATA_FILE)
-        df["Data"] = pd.to_datetime(df["Data"], errors="coerce")
-        return df
+        return pd.read_parquet(RIEPILOGO_FILE, engine="pyarrow")
     except (FileNotFoundError, ValueError):
-        return pd.DataFrame(columns=["Data", "Portafoglio", "Tipo", "Categoria", "Descrizione", "Importo"])
+        return pd.DataFrame(columns=TIPI, index=pd.DatetimeIndex([], name="AnnoMese"), dtype=float)
+
+def versione_riepilogo():
+    # Versione dei dati da cui è stato calcolato il riepilogo, salvata nei suoi metadati
+    try:
+        metadati = pq.read_schema(RIEPILOGO_FILE).metadata or {}
+    except (OSError, ValueError):
+        return None
+    versione = metadati.get(b"versione_dati")
+    return versione.decode("utf-8") if versione else None
+
+def salva_riepilogo(riepilogo, versione):
+    tabella = pa.Table.from_pandas(riepilogo)
+    metadati = {**tabella.schema.metadata, b"versione_dati": json.dumps(versione).encode("utf-8")}
+    pq.write_table(tabella.replace_schema_metadata(metadati), RIEPILOGO_FILE)
+    load_riepilogo.clear()
+
+def aggiorna_riepilogo():
+    # Riepilogo non allineato ai dati (crash dopo l'append, sessioni concorrenti,
+    # archivio sostituito a mano, anche con un backup più vecchio): lo si
+    # ricalcola dall'archivio completo
+    versione = versione_dati()
+    if versione_riepilogo() != json.dumps(versione):
+        salva_riepilogo(calcola_riepilogo(load_data(versione)), versione)
+
+def aggiorna_mese(riga, versione):
+    # Somma la nuova operazione alla riga del suo mese, senza rileggere l'archivio
+    riepilogo = load_riepilogo(stato_file(RIEPILOGO_FILE))
+    data = pd.to_datetime(riga["Data"], errors="coerce")
+    if pd.notna(data) and riga["Tipo"] in TIPI:
+        mese = data.to_period("M").to_timestamp()
+        if mese not in riepilogo.index:
+            riepilogo.loc[mese] = 0.0
+            riepilogo = riepilogo.sort_index()
+        riepilogo.loc[mese, riga["Tipo"]] += float(riga["Importo"])
+    salva_riepilogo(riepilogo, versione)
 
 def save_data(df):
-    df.to_json(DATA_FILE, orient="records", indent=2, date_format="iso")
+    df[COLONNE].to_parquet(DATA_FILE, engine="pyarrow", compression="zstd", index=False)
+    # L'archivio riscritto contiene già le righe del journal
+    if os.path.exists(JOURNAL_FILE):
+        os.remove(JOURNAL_FILE)
+    load_archivio.clear()
+    load_data.clear()
+    salva_riepilogo(calcola_riepilogo(df), versione_dati())
+
+def aggiungi_operazione(riga):
+    prima = versione_dati()
+    linea = (json.dumps(riga, ensure_ascii=False) + "\n").encode("utf-8")
+    with open(JOURNAL_FILE, "ab") as f:
+        f.write(linea)
+    load_data.clear()
+    dopo = versione_dati()
+    # Aggiornamento incrementale solo se il riepilogo era allineato e il journal
+    # è cresciuto esattamente della nostra riga; altrimenti ricalcolo completo
+    if (versione_riepilogo() == json.dumps(prima) and dopo[0] == prima[0]
+            and dopo[1][1] == prima[1][1] + len(linea)):
+        aggiorna_mese(riga, dopo)
+    else:
+        aggiorna_riepilogo()
+    if dopo[1][1] > JOURNAL_MAX_BYTES:
+        save_data(load_data(versione_dati()))
+
+def prepara_archivio():
+    # Conversione una tantum del vecchio archivio JSON in Parquet
+    if not os.path.exists(DATA_FILE) and os.path.exists(LEGACY_FILE):
+        try:
+            save_data(applica_schema(pd.read_json(LEGACY_FILE)))
+        except ValueError:
+            pass
+    aggiorna_riepilogo()
+
+# Separatori all'italiana: virgola e punto scambiati in un solo passaggio
+_SEPARATORI_IT = str.maketrans({",": ".", ".": ","})
 
 def format_currency(value):
-    return f"{value:,.2f} €".replace(",", "X").replace(".", ",").replace("X", ".")
+    return f"{value:,.2f} €".translate(_SEPARATORI_IT)
+
+def disegna_torta(ax, valori, etichette, titolo, colori=None, legenda=False):
+    if legenda:
+        # Etichette in legenda sotto la torta: restano nell'area assegnata anche se lunghe.
+        # Palette a 20 colori perché la legenda resti univoca; niente percentuali sugli spicchi sottili
+        spicchi, _, _ = ax.pie(valori, autopct=lambda p: f"{p:.1f}%" if p >= 4 else "",
+                               startangle=90, colors=colori or plt.get_cmap("tab20").colors)
+        ax.legend(spicchi, etichette, loc="upper center", bbox_to_anchor=(0.5, 0),
+                  fontsize=9, frameon=False)
+    else:
+        ax.pie(valori, labels=etichette, autopct="%1.1f%%", startangle=90, colors=colori)
+    ax.set_title(titolo)
+
+def figura_torta(valori, etichette, titolo, colori=None):
+    fig, ax = plt.subplots()
+    disegna_torta(ax, valori, etichette, titolo, colori)
+    return fig
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def torta_png(valori, etichette, titolo, colori=None):
+    # La figura viene ridisegnata solo quando cambiano i dati del grafico.
+    # Ogni insieme di dati superato resta una voce: la cache è limitata
+    fig = figura_torta(valori, etichette, titolo, colori)
+    buffer = BytesIO()
+    # Stessa resa di st.pyplot: dpi 200, poi st.image la adatta alla larghezza del contenitore
+    fig.savefig(buffer, format="png", dpi=200, bbox_inches="tight")
+    plt.close(fig)
+    return buffer.getvalue()
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def report_pdf(versione, mese, anno):
+    # Riusato finché archivio e journal non cambiano; le versioni superate escono dalla cache
+    buffer = genera_report_pdf(load_data(versione), mese, anno)
+    return buffer.getvalue() if buffer else None
+
+def somme_per_portafoglio(df):
+    # Matrice portafogli x TIPI in un solo passaggio sui codici delle category:
+    # la chiave codice_portafoglio * len(TIPI) + codice_tipo indicizza una cella.
+    # I vocabolari fissi stanno in testa, quindi codice i -> PORTAFOGLI[i], TIPI[i]
+    port = df["Portafoglio"].cat.codes.to_numpy().astype(np.int64)
+    tipo = df["Tipo"].cat.codes.to_numpy()
+    n_port = len(df["Portafoglio"].cat.categories)
+    importo = df["Importo"].to_numpy()
+    # Come groupby().sum(), gli importi mancanti non contano
+    validi = (port >= 0) & (tipo >= 0) & (tipo < len(TIPI)) & ~np.isnan(importo)
+    chiavi = port[validi] * len(TIPI) + tipo[validi]
+    somme = np.bincount(chiavi, weights=importo[validi],
+                        minlength=n_port * len(TIPI))
+    return somme.reshape(n_port, len(TIPI))
+
+def spese_e_stipendio(df_mese):
+    # Un solo raggruppamento per Categoria e Tipo al posto delle maschere composte
+    somme = df_mese.groupby(["Categoria", "Tipo"], observed=True)["Importo"].sum().unstack(fill_value=0.0)
+    somme = somme.reindex(columns=TIPI, fill_value=0.0)
+    spese = somme["Uscita"]
+    spese_categoria = spese[spese > 0].sort_values(ascending=False)
+    entrate_stipendio = somme["Entrata"].get("Stipendio", 0.0)
+    # Totale su tutte le uscite del mese, anche quelle senza categoria
+    spese_totali = df_mese.loc[df_mese["Tipo"] == "Uscita", "Importo"].sum()
+    return spese_categoria, entrate_stipendio, spese_totali
 
 def genera_report_pdf(df, mese, anno):
-    df['AnnoMese'] = df['Data'].dt.to_period('M').dt.to_timestamp()
-    df_mese = df[(df['Data'].dt.year == anno) & (df['Data'].dt.month == mese)]
+    df_mese = righe_del_mese(df, anno, mese)
     if df_mese.empty:
         return None
 
     # Calcoli principali
-    saldi = {}
-    for p in PORTAFOGLI:
-        entrate = df_mese[(df_mese["Portafoglio"]==p) & (df_mese["Tipo"]=="Entrata")]["Importo"].sum()
-        spese = df_mese[(df_mese["Portafoglio"]==p) & (df_mese["Tipo"]=="Uscita")]["Importo"].sum()
-        saldi[p] = entrate - spese
-
-    totale_entrate = df_mese[df_mese["Tipo"]=="Entrata"]["Importo"].sum()
-    totale_spese = df_mese[df_mese["Tipo"]=="Uscita"]["Importo"].sum()
+    somme = somme_per_portafoglio(df_mese)
+    entrate, uscite = somme[:len(PORTAFOGLI)].T
+    saldi = dict(zip(PORTAFOGLI, entrate - uscite))
+    totale_entrate, totale_spese = somme.sum(axis=0)
     risparmio_mese = totale_entrate - totale_spese
 
-    # Crea PDF in memoria
-    buffer = BytesIO()
-    c = canvas.Canvas(buffer, pagesize=A4)
-    width, height = A4
+    # Report su una pagina A4 disegnata con matplotlib e salvata come PDF vettoriale.
+    # Coordinate in pollici dall'angolo in basso a sinistra: cm converte da centimetri
+    cm = 1 / 2.54
+    width, height = 21*cm, 29.7*cm
+    fig = plt.figure(figsize=(width, height))
+    pagina = fig.dpi_scale_trans
 
     # Titolo
-    c.setFont("Helvetica-Bold", 16)
-    c.drawString(3*cm, height-2*cm, f"Report Finanze Personali - {calendar.month_name[mese]} {anno}")
+    fig.text(3*cm, height-2*cm, f"Report Finanze Personali - {calendar.month_name[mese]} {anno}",
+             transform=pagina, fontsize=16, fontweight="bold")
 
     # Saldi portafogli
-    c.setFont("Helvetica", 12)
     y = height-3*cm
-    c.drawString(3*cm, y, "💳 Saldi portafogli:")
+    fig.text(3*cm, y, "Saldi portafogli:", transform=pagina, fontsize=12)
     y -= 0.7*cm
-    for p, saldo in saldi.items():
-        c.drawString(4*cm, y, f"- {p}: {saldo:.2f} €")
-        y -= 0.5*cm
+    fig.text(4*cm, y + 0.4*cm, "\n".join(f"- {p}: {saldo:.2f} €" for p, saldo in saldi.items()),
+             transform=pagina, fontsize=12, va="top")
+    y -= 0.5*cm * len(saldi)
 
     y -= 0.3*cm
-    c.drawString(3*cm, y, f"💸 Entrate totali: {totale_entrate:.2f} €")
+    fig.text(3*cm, y, f"Entrate totali: {totale_entrate:.2f} €", transform=pagina, fontsize=12)
     y -= 0.5*cm
-    c.drawString(3*cm, y, f"💰 Uscite totali: {totale_spese:.2f} €")
+    fig.text(3*cm, y, f"Uscite totali: {totale_spese:.2f} €", transform=pagina, fontsize=12)
     y -= 0.5*cm
-    c.drawString(3*cm, y, f"💵 Risparmio mese: {risparmio_mese:.2f} €")
+    fig.text(3*cm, y, f"Risparmio mese: {risparmio_mese:.2f} €", transform=pagina, fontsize=12)
     y -= 1*cm
 
     # ================================
     # Grafici a torta affiancati
     # ================================
+    spese_categoria, entrate_stipendio, _ = spese_e_stipendio(df_mese)
+
+    def area_grafico(x):
+        return [x/width, (y-10*cm)/height, 8*cm/width, 8*cm/height]
+
     # 1) Spese per categoria
-    spese_mese = df[(df["Tipo"] == "Uscita") & 
-                    (df["AnnoMese"] == pd.Timestamp(year=anno, month=mese, day=1))]
-    if not spese_mese.empty:
-        spese_categoria = spese_mese.groupby("Categoria")["Importo"].sum().sort_values(ascending=False)
-        fig1, ax1 = plt.subplots()
-        ax1.pie(spese_categoria, labels=spese_categoria.index, autopct="%1.1f%%", startangle=90)
-        ax1.set_title("Distribuzione spese")
-        img_buffer1 = BytesIO()
-        fig1.savefig(img_buffer1, format='PNG', bbox_inches='tight')
-        img_buffer1.seek(0)
-        img1 = ImageReader(img_buffer1)
-        plt.close(fig1)
-    else:
-        img1 = None
+    if not spese_categoria.empty:
+        disegna_torta(fig.add_axes(area_grafico(3*cm)),
+                      spese_categoria, spese_categoria.index, "Distribuzione spese", legenda=True)
 
     # 2) Stipendio vs spese
-    entrate_stipendio = df[
-        (df["Tipo"] == "Entrata") &
-        (df["Categoria"] == "Stipendio") &
-        (df["AnnoMese"] == pd.Timestamp(year=anno, month=mese, day=1))
-    ]["Importo"].sum()
     if entrate_stipendio > 0:
         rimanente = max(entrate_stipendio - totale_spese, 0)
-        dati_pie = [totale_spese, rimanente]
-        etichette = ["Spese totali", "Stipendio rimanente"]
-        fig2, ax2 = plt.subplots()
-        ax2.pie(dati_pie, labels=etichette, autopct="%1.1f%%", startangle=90, colors=["#ff9999","#99ff99"])
-        ax2.set_title("Stipendio vs Spese")
-        img_buffer2 = BytesIO()
-        fig2.savefig(img_buffer2, format='PNG', bbox_inches='tight')
-        img_buffer2.seek(0)
-        img2 = ImageReader(img_buffer2)
-        plt.close(fig2)
-    else:
-        img2 = None
-
-    # Inserimento grafici affiancati
-    if img1:
-        c.drawImage(img1, 3*cm, y-10*cm, width=8*cm, height=8*cm)
-    if img2:
-        c.drawImage(img2, 11*cm, y-10*cm, width=8*cm, height=8*cm)
+        disegna_torta(fig.add_axes(area_grafico(11*cm)),
+                      [totale_spese, rimanente], ["Spese totali", "Stipendio rimanente"],
+                      "Stipendio vs Spese", ["#ff9999", "#99ff99"], legenda=True)
 
-    c.showPage()
-    c.save()
+    buffer = BytesIO()
+    fig.savefig(buffer, format="pdf")
+    plt.close(fig)
     buffer.seek(0)
     return buffer
 
 # -----------------------------
 # CARICA DATI
 # -----------------------------
-df = load_data()
+prepara_archivio()
 
 # -----------------------------
 # NAVIGAZIONE
@@ -153,17 +339,22 @@ sezione = st.sidebar.radio("📂 Sezioni", ["🏠 Dashboard", "🧾 Transazioni"
 # -----------------------------
 if sezione == "🏠 Dashboard":
     st.header("📊 Panoramica generale")
-    if df.empty:
+    # La Dashboard legge solo il riepilogo mensile, mai l'intero storico
+    riepilogo = load_riepilogo(stato_file(RIEPILOGO_FILE))
+    if riepilogo.empty and not load_data(versione_dati()).empty:
+        # Caso limite: operazioni presenti ma tutte senza una data valida
+        st.info("Nessuna operazione con una data valida da riepilogare.")
+    elif riepilogo.empty:
         st.info("Ancora nessuna operazione registrata. Vai su **Transazioni** per aggiungerne una.")
     else:
-        df["MeseAnno"] = df["Data"].dt.to_period("M")
-        totale_entrate = df[df["Tipo"] == "Entrata"]["Importo"].sum()
-        totale_uscite = df[df["Tipo"] == "Uscita"]["Importo"].sum()
+        totale_entrate = riepilogo["Entrata"].sum()
+        totale_uscite = riepilogo["Uscita"].sum()
         risparmio_totale = totale_entrate - totale_uscite
-        mese_corrente = datetime.now().strftime("%Y-%m")
-        df_mese = df[df["MeseAnno"] == mese_corrente]
-        entrate_mese = df_mese[df_mese["Tipo"] == "Entrata"]["Importo"].sum()
-        uscite_mese = df_mese[df_mese["Tipo"] == "Uscita"]["Importo"].sum()
+        oggi = datetime.now()
+        mese_corrente = pd.Timestamp(year=oggi.year, month=oggi.month, day=1)
+        riga_mese = riepilogo.reindex([mese_corrente], fill_value=0.0).iloc[0]
+        entrate_mese = riga_mese["Entrata"]
+        uscite_mese = riga_mese["Uscita"]
         risparmio_mese = entrate_mese - uscite_mese
 
         col1, col2, col3 = st.columns(3)
@@ -184,7 +375,7 @@ elif sezione == "🧾 Transazioni":
 
     col3, col4, col5 = st.columns(3)
     with col3:
-        tipo = st.selectbox("Tipo", ["Entrata", "Uscita"])
+        tipo = st.selectbox("Tipo", TIPI)
     with col4:
         portafoglio = st.selectbox("Portafoglio", PORTAFOGLI)
     with col5:
@@ -195,40 +386,42 @@ elif sezione == "🧾 Transazioni":
 
     if st.button("💾 Aggiungi operazione"):
         if descrizione and importo > 0:
-            new_row = pd.DataFrame({
-                "Data": [data],
-                "Portafoglio": [portafoglio],
-                "Tipo": [tipo],
-                "Categoria": [categoria],
-                "Descrizione": [descrizione],
-                "Importo": [importo]
+            aggiungi_operazione({
+                "Data": data.isoformat(),
+                "Portafoglio": portafoglio,
+                "Tipo": tipo,
+                "Categoria": categoria,
+                "Descrizione": descrizione,
+                "Importo": importo
             })
-            df = pd.concat([df, new_row], ignore_index=True)
-            save_data(df)
             st.success(f"{tipo} aggiunta con successo!")
         else:
             st.warning("Compila tutti i campi correttamente.")
 
     st.divider()
     st.header("📄 Storico operazioni")
+    df = load_data(versione_dati())
     if df.empty:
         st.info("Nessuna operazione registrata.")
     else:
-        st.dataframe(df.sort_values(by="Data", ascending=False), hide_index=True)
+        # Al frontend arrivano solo le operazioni più recenti, non l'intero storico
+        righe = st.number_input("Operazioni da mostrare", min_value=50, max_value=5000, value=200, step=50)
+        # load_data ordina per data con le date mancanti in testa: a ritroso finiscono in coda
+        visibili = df.iloc[::-1].head(int(righe))[COLONNE]
+        st.dataframe(visibili, hide_index=True)
+        st.caption(f"Ultime {len(visibili)} di {len(df)} operazioni")
 
 # -----------------------------
 # ANALISI
 # -----------------------------
 elif sezione == "📈 Analisi":
     st.header("📊 Analisi mensile e andamento portafogli")
+    df = load_data(versione_dati())
     if df.empty:
         st.info("Nessun dato disponibile per l’analisi.")
     else:
-        df["AnnoMese"] = df["Data"].dt.to_period("M").dt.to_timestamp()
-        mensile = df.groupby(["AnnoMese", "Tipo"])["Importo"].sum().unstack(fill_value=0)
-        for col in ["Entrata", "Uscita"]:
-            if col not in mensile.columns:
-                mensile[col] = 0
+        # Entrate e uscite per mese sono già aggregate nel riepilogo
+        mensile = load_riepilogo(stato_file(RIEPILOGO_FILE))
         mensile["Risparmio"] = mensile["Entrata"] - mensile["Uscita"]
         mensile["Risparmio cumulativo"] = mensile["Risparmio"].cumsum()
 
@@ -238,57 +431,64 @@ elif sezione == "📈 Analisi":
 
         # Andamento portafogli
         st.subheader("💳 Andamento portafogli nel tempo")
-        portafogli_mensili = df.groupby(["AnnoMese", "Portafoglio"])["Importo"].sum().unstack(fill_value=0)
-        for p in PORTAFOGLI:
-            if p not in portafogli_mensili.columns:
-                portafogli_mensili[p] = 0
+        portafogli_mensili = df.pivot_table(index="AnnoMese", columns="Portafoglio", values="Importo",
+                                            aggfunc="sum", fill_value=0, observed=True)
+        portafogli_mensili = portafogli_mensili.reindex(columns=df["Portafoglio"].cat.categories, fill_value=0)
         portafogli_mensili = portafogli_mensili.cumsum()
         st.line_chart(portafogli_mensili)
 
         # Grafici a torta del mese selezionato
         st.subheader("🥧 Analisi spese e stipendio")
-        mesi_disponibili = sorted(df["AnnoMese"].unique())
-        mese_scelto = st.selectbox("Seleziona mese", mesi_disponibili)
+        # I mesi disponibili sono l'indice, già ordinato, del riepilogo
+        mese_scelto = st.selectbox("Seleziona mese", mensile.index,
+                                   format_func=lambda m: m.strftime("%B %Y"))
+        if mese_scelto is None:
+            # Operazioni presenti ma nessuna con una data valida: nessun mese da proporre
+            st.info("Nessuna operazione con una data valida da analizzare per mese.")
+        else:
+            df_mese = righe_del_mese(df, mese_scelto.year, mese_scelto.month)
+            spese_categoria, entrate_stipendio, spese_totali_mese = spese_e_stipendio(df_mese)
         
-        # Spese per categoria
-        spese_mese = df[(df["Tipo"]=="Uscita") & (df["AnnoMese"]==pd.Timestamp(mese_scelto))]
-        if not spese_mese.empty:
-            spese_categoria = spese_mese.groupby("Categoria")["Importo"].sum().sort_values(ascending=False)
-            fig, ax = plt.subplots()
-            ax.pie(spese_categoria, labels=spese_categoria.index, autopct="%1.1f%%", startangle=90)
-            ax.set_title(f"Distribuzione spese - {mese_scelto.strftime('%B %Y')}")
-            st.pyplot(fig)
+            # Spese per categoria
+            if not spese_categoria.empty:
+                st.image(torta_png(
+                    tuple(spese_categoria), tuple(spese_categoria.index),
+                    f"Distribuzione spese - {mese_scelto.strftime('%B %Y')}"
+                ), width="stretch")
         
-        # Stipendio vs spese
-        entrate_stipendio = df[(df["Tipo"]=="Entrata") & (df["Categoria"]=="Stipendio") & (df["AnnoMese"]==pd.Timestamp(mese_scelto))]["Importo"].sum()
-        spese_totali_mese = df[(df["Tipo"]=="Uscita") & (df["AnnoMese"]==pd.Timestamp(mese_scelto))]["Importo"].sum()
-        if entrate_stipendio > 0:
-            rimanente = max(entrate_stipendio - spese_totali_mese, 0)
-            fig2, ax2 = plt.subplots()
-            ax2.pie([spese_totali_mese, rimanente], labels=["Spese totali", "Stipendio rimanente"],
-                    autopct="%1.1f%%", startangle=90, colors=["#ff9999","#99ff99"])
-            ax2.set_title(f"Stipendio vs Spese - {mese_scelto.strftime('%B %Y')}")
-            st.pyplot(fig2)
-            st.write(f"**Totale stipendio:** {entrate_stipendio:.2f} €")
-            st.write(f"**Totale spese:** {spese_totali_mese:.2f} €")
-            st.write(f"**Risparmio mensile (stipendio - spese):** {rimanente:.2f} €")
-        else:
-            st.info("Nessuno stipendio registrato per questo mese.")
+            # Stipendio vs spese
+            if entrate_stipendio > 0:
+                rimanente = max(entrate_stipendio - spese_totali_mese, 0)
+                st.image(torta_png(
+                    (spese_totali_mese, rimanente), ("Spese totali", "Stipendio rimanente"),
+                    f"Stipendio vs Spese - {mese_scelto.strftime('%B %Y')}", ("#ff9999", "#99ff99")
+                ), width="stretch")
+                st.write(f"**Totale stipendio:** {entrate_stipendio:.2f} €")
+                st.write(f"**Totale spese:** {spese_totali_mese:.2f} €")
+                st.write(f"**Risparmio mensile (stipendio - spese):** {rimanente:.2f} €")
+            else:
+                st.info("Nessuno stipendio registrato per questo mese.")
 
         st.divider()
         # Export CSV
-        st.download_button("⬇️ Esporta CSV", df.to_csv(index=False).encode("utf-8"), "finanze.csv", "text/csv")
-
-        # Export PDF
-        mese_corrente = datetime.now().month
-        anno_corrente = datetime.now().year
-        pdf_buffer = genera_report_pdf(df, mese_corrente, anno_corrente)
-        if pdf_buffer:
-            st.download_button(
-                "📄 Esporta report PDF",
-                data=pdf_buffer,
-                file_name=f"Report_Finanze_{calendar.month_name[mese_corrente]}_{anno_corrente}.pdf",
-                mime="application/pdf"
-            )
-        else:
-            st.info("Nessuna operazione registrata per questo mese.")
+        st.download_button("⬇️ Esporta CSV", df[COLONNE].to_csv(index=False).encode("utf-8"), "finanze.csv", "text/csv")
+
+        # Export PDF: generato solo su richiesta, non a ogni rerun
+        oggi = datetime.now()
+        mese_corrente = oggi.month
+        anno_corrente = oggi.year
+        chiave_pdf = (versione_dati(), mese_corrente, anno_corrente)
+        if st.button("📄 Prepara report PDF"):
+            with st.spinner("Generazione del report..."):
+                st.session_state["report_pdf"] = (chiave_pdf, report_pdf(*chiave_pdf))
+        pronto = st.session_state.get("report_pdf")
+        if pronto and pronto[0] == chiave_pdf:
+            if pronto[1]:
+                st.download_button(
+                    "📄 Esporta report PDF",
+                    data=pronto[1],
+                    file_name=f"Report_Finanze_{calendar.month_name[mese_corrente]}_{anno_corrente}.pdf",
+                    mime="application/pdf"
+                )
+            else:
+                st.info("Nessuna operazione registrata per questo mese.")